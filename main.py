@@ -1,40 +1,299 @@
 
 # === Imports ===
+import asyncio
+import logging
 import os
+import threading
+import time
 import uuid
+from contextlib import asynccontextmanager
 from datetime import date
+from functools import lru_cache
+from typing import Annotated
+from types import MappingProxyType
+import anyio.to_thread
 from fastapi import FastAPI, Form, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from gspread.utils import rowcol_to_a1
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+from pydantic import BaseModel, ValidationInfo, field_validator
+from requests.adapters import HTTPAdapter
 
 
-# === App and Templates ===
-app = FastAPI()
+# === Templates ===
 templates = Jinja2Templates(directory="templates")
+# Templates are resolved once below, so skip the per-render mtime checks
+templates.env.auto_reload = False
+TEMPLATE_NAMES = ("index.html", "recebimiento.html", "trillado.html", "perfilado.html", "tostado.html")
+_TEMPLATES = {name: templates.get_template(name) for name in TEMPLATE_NAMES}
+logger = logging.getLogger(__name__)
+
+
+def render(name: str, context: dict) -> HTMLResponse:
+    """Render a template resolved at import time."""
+    return HTMLResponse(_TEMPLATES[name].render(context))
 
 
 # === Google Sheets Utility ===
 CREDENTIALS_PATH = os.environ.get("GOOGLE_CREDENTIALS_JSON", "credentials.json")
 SHEET_NAME = os.environ.get("GOOGLE_SHEET_NAME", "Coffee Roaster - Recebimiento")
-
+SCOPE = (
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive"
+)
+ID_CACHE_TTL = float(os.environ.get("ID_CACHE_TTL", "30"))
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "20"))
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "15"))
+# Threads available to run_in_threadpool; the HTTP pool matches it so no call waits for a connection
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "64"))
+HTTP_POOL_SIZE = THREADPOOL_SIZE
+# Worker processes, read from the variable uvicorn and gunicorn use for their default worker count
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+
+
+_CREDS = None
+_CLIENT = None
+_SPREADSHEET = None
+_WS_CACHE = {}
+_SHEETS_LOCK = threading.Lock()
+_ID_CACHE = {}
+_ID_REFRESHES = {}
+_ID_CACHE_LOCK = threading.Lock()
+_APPEND_LOCKS = {}
+
+# (worksheet, column) pairs holding the IDs used for dropdowns and duplicate checks
+ID_COLUMNS = [
+    ("Recebimiento", 1),
+    ("Trillado", 6),
+    ("Perfilado", 1),
+    ("Perfilado", 28),
+    ("Tostado", 8),
+]
+
+
+def get_credentials():
+    """Return the service account credentials, parsing the keyfile only once per process."""
+    global _CREDS
+    if _CREDS is None:
+        _CREDS = Credentials.from_service_account_file(CREDENTIALS_PATH, scopes=SCOPE)
+    return _CREDS
+
+
+def get_spreadsheet():
+    """Return the spreadsheet, authorizing and opening it only once per process."""
+    global _CLIENT, _SPREADSHEET
+    with _SHEETS_LOCK:
+        if _CLIENT is None:
+            creds = get_credentials()
+            # Keep enough pooled keep-alive connections to Google for concurrent requests
+            session = AuthorizedSession(creds)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            client = gspread.authorize(creds, session=session)
+            # The client is shared behind locks, so a hung call must not block forever
+            client.set_timeout(SHEETS_TIMEOUT)
+            _CLIENT = client
+        if _SPREADSHEET is None:
+            _SPREADSHEET = _CLIENT.open(SHEET_NAME)
+        return _SPREADSHEET
 
 
 def get_sheet(work_sheet_name: str):
-    """Return a worksheet object by name."""
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
+    """Return a worksheet object by name (cached after the first lookup)."""
+    spreadsheet = get_spreadsheet()
+    with _SHEETS_LOCK:
+        if work_sheet_name not in _WS_CACHE:
+            _WS_CACHE[work_sheet_name] = spreadsheet.worksheet(work_sheet_name)
+        return _WS_CACHE[work_sheet_name]
+
+
+def load_worksheets():
+    """Cache every worksheet handle with a single metadata fetch."""
+    worksheets = get_spreadsheet().worksheets()
+    with _SHEETS_LOCK:
+        for worksheet in worksheets:
+            _WS_CACHE.setdefault(worksheet.title, worksheet)
+
+
+def get_id_columns(*columns):
+    """Read several (worksheet, column) ID columns in a single batchGet, skipping headers."""
+    ranges = []
+    for work_sheet_name, col in columns:
+        letter = rowcol_to_a1(1, col)[:-1]
+        ranges.append(f"'{work_sheet_name}'!{letter}2:{letter}")
+    response = get_spreadsheet().values_batch_get(ranges, params={"majorDimension": "COLUMNS"})
+    return [
+        (value_range.get("values") or [[]])[0]
+        for value_range in response.get("valueRanges", [])
     ]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_PATH, scope)
-    client = gspread.authorize(creds)
-    return client.open(SHEET_NAME).worksheet(work_sheet_name)
+
+
+class _IdRefresh:
+    """A fetch of one or more ID columns that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        # IDs appended and worksheets invalidated while the fetch was running
+        self.appended = {}
+        self.invalidated = set()
+
+
+def get_cached_ids(*columns, max_age: float = None):
+    """Return the IDs of each (worksheet, column), refetching only entries older than max_age.
+
+    max_age defaults to ID_CACHE_TTL.
+
+    Each entry is an insertion-ordered dict used as an ordered set, so it keeps
+    the sheet order for dropdowns and gives constant-time duplicate checks.
+    Stale columns are fetched outside the cache lock; a column already being
+    fetched by another thread is waited on instead of fetched twice.
+    """
+    with _ID_CACHE_LOCK:
+        now = time.monotonic()
+        if max_age is None:
+            max_age = ID_CACHE_TTL
+        stale = [c for c in columns if c not in _ID_CACHE or now - _ID_CACHE[c][0] >= max_age]
+        others = {_ID_REFRESHES[c] for c in stale if c in _ID_REFRESHES}
+        mine = [c for c in stale if c not in _ID_REFRESHES]
+        refresh = _IdRefresh()
+        for column in mine:
+            _ID_REFRESHES[column] = refresh
+    if mine:
+        fetched = None
+        try:
+            fetched = get_id_columns(*mine)
+        finally:
+            with _ID_CACHE_LOCK:
+                for column in mine:
+                    del _ID_REFRESHES[column]
+                for column, ids in zip(mine, fetched or ()):
+                    if column[0] in refresh.invalidated:
+                        continue
+                    ids = dict.fromkeys(ids)
+                    ids.update(dict.fromkeys(refresh.appended.get(column, ())))
+                    _ID_CACHE[column] = (now, ids)
+            refresh.done.set()
+    for other in others:
+        other.done.wait()
+    with _ID_CACHE_LOCK:
+        if all(c in _ID_CACHE for c in columns):
+            return [_ID_CACHE[c][1] for c in columns]
+    # A fetch this call relied on failed or was invalidated, so fetch again
+    return get_cached_ids(*columns, max_age=max_age)
+
+
+def invalidate_ids(work_sheet_name: str):
+    """Drop every cached ID column of a worksheet, including fetches still running."""
+    with _ID_CACHE_LOCK:
+        for column in [c for c in _ID_CACHE if c[0] == work_sheet_name]:
+            del _ID_CACHE[column]
+        for (name, _), refresh in _ID_REFRESHES.items():
+            if name == work_sheet_name:
+                refresh.invalidated.add(name)
+
+
+def append_row(work_sheet_name: str, row: list):
+    """Append a row to a worksheet and record its IDs in the cached ID columns."""
+    try:
+        get_sheet(work_sheet_name).append_row(row)
+    except (gspread.exceptions.APIError, requests.RequestException):
+        # The row may have been written even though the call failed
+        invalidate_ids(work_sheet_name)
+        raise
+    with _ID_CACHE_LOCK:
+        for (name, col), (_, ids) in _ID_CACHE.items():
+            if name == work_sheet_name:
+                ids[row[col - 1]] = None
+        for (name, col), refresh in _ID_REFRESHES.items():
+            if name == work_sheet_name:
+                refresh.appended.setdefault((name, col), []).append(row[col - 1])
+
+
+async def fetch_ids(work_sheet_name: str, col: int, stale_ok: bool = False):
+    """Return the cached IDs of a column, only using the threadpool when they must be refetched.
+
+    With stale_ok, any cached entry is returned as is, whatever its age.
+    """
+    entry = _ID_CACHE.get((work_sheet_name, col))
+    if entry is not None and (stale_ok or time.monotonic() - entry[0] < ID_CACHE_TTL):
+        return entry[1]
+    return (await run_in_threadpool(get_cached_ids, (work_sheet_name, col)))[0]
+
+
+async def get_id_options(work_sheet_name: str, col: int, stale_ok: bool = False) -> list:
+    """Return the IDs of a column as a list for a dropdown."""
+    return list(await fetch_ids(work_sheet_name, col, stale_ok))
+
+
+async def append_unique_row(work_sheet_name: str, col: int, row: list) -> bool:
+    """Append a row unless its ID (in column col) is already registered.
+
+    The check and the append run under a per-worksheet lock, so concurrent
+    submissions of the same ID cannot both be written.
+    """
+    lock = _APPEND_LOCKS.setdefault(work_sheet_name, asyncio.Lock())
+    async with lock:
+        if WORKERS > 1:
+            # Other workers may have appended since this worker's cache was filled
+            ids = (await run_in_threadpool(get_cached_ids, (work_sheet_name, col), max_age=0))[0]
+        else:
+            ids = await fetch_ids(work_sheet_name, col)
+        if row[col - 1] in ids:
+            return False
+        await run_in_threadpool(append_row, work_sheet_name, row)
+        return True
+
+
+async def warm_caches():
+    """Authorize, open the worksheets and load the ID columns before the first request."""
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                run_in_threadpool(load_worksheets),
+                run_in_threadpool(get_cached_ids, *ID_COLUMNS)
+            ),
+            timeout=WARMUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        # Start serving anyway; whatever did not load is loaded lazily
+        logger.warning("Warming the Google Sheets caches took over %s s, skipping", WARMUP_TIMEOUT)
+    except Exception:
+        # Fall back to loading everything lazily on the first requests
+        logger.exception("Could not warm the Google Sheets caches")
+
+
+@lru_cache(maxsize=1)
+def _iso_date(day_ordinal: int) -> str:
+    return date.fromordinal(day_ordinal).isoformat()
+
+
+def today_str() -> str:
+    """Return today's date as YYYY-MM-DD, formatted once per day."""
+    return _iso_date(date.today().toordinal())
+
+
+# === App ===
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Raise the threadpool limit and warm the Google Sheets caches before serving."""
+    # Concurrent gspread calls run in the threadpool and should not queue
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await warm_caches()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/", response_class=HTMLResponse)
-def home(request: Request):
-    return templates.TemplateResponse(
+async def home(request: Request):
+    return render(
         "index.html",
         {
             "request": request
@@ -43,27 +302,34 @@ def home(request: Request):
 
 
 # === Recebimiento Routes ===
+_RECEBIMIENTO_DEFAULTS = MappingProxyType({
+    "provedor": "",
+    "ciudad": "",
+    "origen": "",
+    "lote_bolsa": "",
+    "cantidad_kg": "",
+    "humedad": "",
+    "motorista": "",
+    "vehiculo_placa": "",
+    "observacion": "",
+    "libre_contaminacion": "yes",
+    "vehiculo_sin_contaminacion": "yes",
+    "buen_estado": "yes",
+    "responsable": ""
+})
+
+
+def yes_no(checkbox: str) -> str:
+    """Normalize a checkbox value: "yes" when ticked, "no" when missing or anything else."""
+    return "yes" if checkbox == "yes" else "no"
+
+
 @app.get("/recebimiento", response_class=HTMLResponse)
-def form_page(request: Request):
+async def form_page(request: Request):
     """Show the Recebimiento form."""
-    today = date.today().isoformat()
-    defaults = {
-        "fecha": today,
-        "provedor": "",
-        "ciudad": "",
-        "origen": "",
-        "lote_bolsa": "",
-        "cantidad_kg": "",
-        "humedad": "",
-        "motorista": "",
-        "vehiculo_placa": "",
-        "observacion": "",
-        "libre_contaminacion": "yes",
-        "vehiculo_sin_contaminacion": "yes",
-        "buen_estado": "yes",
-        "responsable": ""
-    }
-    return templates.TemplateResponse(
+    today = today_str()
+    defaults = {**_RECEBIMIENTO_DEFAULTS, "fecha": today}
+    return render(
         "recebimiento.html",
         {
             "request": request,
@@ -93,17 +359,13 @@ async def submit_form(
     responsable: str = Form("")
 ):
     """Handle Recebimiento form submission."""
-    sheet = get_sheet("Recebimiento")
-
     # Set checkbox defaults
-    libre_contaminacion = libre_contaminacion if libre_contaminacion == "yes" else "no"
-    vehiculo_sin_contaminacion = vehiculo_sin_contaminacion if vehiculo_sin_contaminacion == "yes" else "no"
-    buen_estado = buen_estado if buen_estado == "yes" else "no"
+    libre_contaminacion = yes_no(libre_contaminacion)
+    vehiculo_sin_contaminacion = yes_no(vehiculo_sin_contaminacion)
+    buen_estado = yes_no(buen_estado)
 
     # Generate unique ID
-    id_recibimiento = (
-        fecha.replace("-", "") + str(provedor[:3]).upper() + str(origen[:3]).upper() + "-" + str(lote_bolsa).upper()
-    )
+    id_recibimiento = f"{fecha.replace('-', '')}{provedor[:3].upper()}{origen[:3].upper()}-{lote_bolsa.upper()}"
 
     # Prepare row (ID as first column)
     row = [
@@ -113,13 +375,11 @@ async def submit_form(
         responsable
     ]
 
-    # Check for duplicate id_recibimiento
-    existing_ids = [r[0] for r in sheet.get_all_values()]
-    if id_recibimiento in existing_ids:
-        msg = f"❌ Ya esta registrado! ID: {id_recibimiento}"
-    else:
-        sheet.append_row(row)
+    # Append unless id_recibimiento is already registered
+    if await append_unique_row("Recebimiento", 1, row):
         msg = f"✅ Registered successfully! ID: {id_recibimiento}"
+    else:
+        msg = f"❌ Ya esta registrado! ID: {id_recibimiento}"
 
     last_submission = {
         "id_recibimiento": id_recibimiento,
@@ -138,50 +398,37 @@ async def submit_form(
         "buen_estado": buen_estado,
         "responsable": responsable
     }
-    defaults = {
-        "fecha": fecha,
-        "provedor": provedor,
-        "ciudad": ciudad,
-        "origen": origen,
-        "lote_bolsa": lote_bolsa,
-        "cantidad_kg": cantidad_kg,
-        "humedad": humedad,
-        "motorista": motorista,
-        "vehiculo_placa": vehiculo_placa,
-        "observacion": observacion,
-        "libre_contaminacion": libre_contaminacion,
-        "vehiculo_sin_contaminacion": vehiculo_sin_contaminacion,
-        "buen_estado": buen_estado,
-        "responsable": responsable
-    }
-    return templates.TemplateResponse(
+    return render(
         "recebimiento.html",
         {
             "request": request,
             "msg": msg,
             "last_submission": last_submission,
-            "defaults": defaults
+            "defaults": last_submission
         }
     )
 
 
 
 # === Trillado GET and POST ===
+_TRILLADO_DEFAULTS = MappingProxyType({
+    "grano_num": "",
+    "cantidad_kg": "",
+    "observacion": ""
+})
+
+
 @app.get("/trillado", response_class=HTMLResponse)
-def trillado_form_page(request: Request):
+async def trillado_form_page(request: Request):
     """Show the Trillado form, with ID Recibimiento options from Recebimiento sheet."""
-    today = date.today().isoformat()
-    sheet_receb = get_sheet("Recebimiento")
-    all_rows = sheet_receb.get_all_values()
-    recibimiento_ids = [r[0] for r in all_rows[1:]] if len(all_rows) > 1 else []
+    today = today_str()
+    recibimiento_ids = await get_id_options("Recebimiento", 1)
     defaults = {
+        **_TRILLADO_DEFAULTS,
         "id_recibimiento": recibimiento_ids[0] if recibimiento_ids else "",
-        "fecha": today,
-        "grano_num": "",
-        "cantidad_kg": "",
-        "observacion": ""
+        "fecha": today
     }
-    return templates.TemplateResponse(
+    return render(
         "trillado.html",
         {
             "request": request,
@@ -203,23 +450,13 @@ async def trillado_submit_form(
     observacion: str = Form("")
 ):
     """Handle Trillado form submission and save to Trillado worksheet."""
-    # Get valid IDs for dropdown
-    sheet_receb = get_sheet("Recebimiento")
-    all_rows = sheet_receb.get_all_values()
-    recibimiento_ids = [r[0] for r in all_rows[1:]] if len(all_rows) > 1 else []
-
     # Save to Trillado worksheet with unique ID Trillado
-    sheet_trillado = get_sheet("Trillado")
     id_trillado = f"{id_recibimiento}-{grano_num}"
-    # Check for duplicate id_trillado
-    trillado_rows = sheet_trillado.get_all_values()
-    existing_ids_trillado = [r[-1] for r in trillado_rows[1:]] if len(trillado_rows) > 1 else []
-    if id_trillado in existing_ids_trillado:
-        msg = f"❌ Ya esta registrado! ID Trillado: {id_trillado}"
-    else:
-        row = [id_recibimiento, fecha, grano_num, cantidad_kg, observacion, id_trillado]
-        sheet_trillado.append_row(row)
+    row = [id_recibimiento, fecha, grano_num, cantidad_kg, observacion, id_trillado]
+    if await append_unique_row("Trillado", 6, row):
         msg = f"✅ Trillado registrado! ID Trillado: {id_trillado}"
+    else:
+        msg = f"❌ Ya esta registrado! ID Trillado: {id_trillado}"
 
     last_submission = {
         "id_recibimiento": id_recibimiento,
@@ -229,62 +466,58 @@ async def trillado_submit_form(
         "observacion": observacion,
         "id_trillado": id_trillado
     }
-    defaults = {
-        "id_recibimiento": id_recibimiento,
-        "fecha": fecha,
-        "grano_num": grano_num,
-        "cantidad_kg": cantidad_kg,
-        "observacion": observacion
-    }
-    return templates.TemplateResponse(
+    return render(
         "trillado.html",
         {
             "request": request,
             "msg": msg,
             "last_submission": last_submission,
-            "defaults": defaults,
-            "recibimiento_ids": recibimiento_ids
+            "defaults": last_submission,
+            "recibimiento_ids": await get_id_options("Recebimiento", 1, stale_ok=True)
         }
     )
 
 
 # === Perfilado GET and POST ===
+_PERFILADO_DEFAULTS = MappingProxyType({
+    "muestra_pergamino": "",
+    "humedad_pergamino": "",
+    "muestra_trillado": "",
+    "malla": "",
+    "densidad": "",
+    "humedad_grano_verde": "",
+    "negro": "",
+    "agrio": "",
+    "cereza_seca": "",
+    "dano_hongo": "",
+    "impurezas": "",
+    "dano_severo_insectos": "",
+    "parcial_negro": "",
+    "parcial_agrio": "",
+    "pergamino": "",
+    "flotador": "",
+    "inmaduro": "",
+    "averanado": "",
+    "concha": "",
+    "partido_mordido": "",
+    "cascara_pulpa_seca": "",
+    "dano_leve_insectos": "",
+    "perfil": "Frutos Citricos",
+    "caramelizacion": "",
+    "desarrollo": ""
+})
+
+
 @app.get("/perfilado", response_class=HTMLResponse)
-def perfilado_form_page(request: Request):
+async def perfilado_form_page(request: Request):
     """Show the Perfilado form, with ID Trillado options from Trillado sheet (column F)."""
-    sheet_trillado = get_sheet("Trillado")
-    trillado_rows = sheet_trillado.get_all_values()
-    # Get all IDs from column F (index 5)
-    id_trillado_options = [r[5] for r in trillado_rows[1:] if len(r) > 5] if len(trillado_rows) > 1 else []
+    # Get all IDs from column F
+    id_trillado_options = await get_id_options("Trillado", 6)
     defaults = {
-        "id_trillado": id_trillado_options[0] if id_trillado_options else "",
-        "muestra_pergamino": "",
-        "humedad_pergamino": "",
-        "muestra_trillado": "",
-        "malla": "",
-        "densidad": "",
-        "humedad_grano_verde": "",
-        "negro": "",
-        "agrio": "",
-        "cereza_seca": "",
-        "dano_hongo": "",
-        "impurezas": "",
-        "dano_severo_insectos": "",
-        "parcial_negro": "",
-        "parcial_agrio": "",
-        "pergamino": "",
-        "flotador": "",
-        "inmaduro": "",
-        "averanado": "",
-        "concha": "",
-        "partido_mordido": "",
-        "cascara_pulpa_seca": "",
-        "dano_leve_insectos": "",
-        "perfil": "Frutos Citricos",
-        "caramelizacion": "",
-        "desarrollo": ""
+        **_PERFILADO_DEFAULTS,
+        "id_trillado": id_trillado_options[0] if id_trillado_options else ""
     }
-    return templates.TemplateResponse(
+    return render(
         "perfilado.html",
         {
             "request": request,
@@ -296,127 +529,101 @@ def perfilado_form_page(request: Request):
     )
 
 
+class PerfiladoForm(BaseModel):
+    """Fields of the Perfilado form, in worksheet column order."""
+    id_trillado: str
+    muestra_pergamino: float = 0
+    humedad_pergamino: float = 0
+    muestra_trillado: float = 0
+    malla: str = ""
+    densidad: float = 0
+    humedad_grano_verde: float = 0
+    negro: float = 0
+    agrio: float = 0
+    cereza_seca: float = 0
+    dano_hongo: float = 0
+    impurezas: float = 0
+    dano_severo_insectos: float = 0
+    parcial_negro: float = 0
+    parcial_agrio: float = 0
+    pergamino: float = 0
+    flotador: float = 0
+    inmaduro: float = 0
+    averanado: float = 0
+    concha: float = 0
+    partido_mordido: float = 0
+    cascara_pulpa_seca: float = 0
+    dano_leve_insectos: float = 0
+    perfil: str = "Frutos Citricos"
+    caramelizacion: float = 0
+    desarrollo: float = 0
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def blank_to_default(cls, value, info: ValidationInfo):
+        """Treat inputs left empty in the browser as the field default, like Form(0) did."""
+        if value == "":
+            field = cls.model_fields[info.field_name]
+            # A blank required field (id_trillado) is still rejected
+            return None if field.is_required() else field.default
+        return value
+
+
 @app.post("/perfilado", response_class=HTMLResponse)
-async def perfilado_submit_form(
-    request: Request,
-    id_trillado: str = Form(...),
-    muestra_pergamino: float = Form(0),
-    humedad_pergamino: float = Form(0),
-    muestra_trillado: float = Form(0),
-    malla: str = Form(""),
-    densidad: float = Form(0),
-    humedad_grano_verde: float = Form(0),
-    negro: float = Form(0),
-    agrio: float = Form(0),
-    cereza_seca: float = Form(0),
-    dano_hongo: float = Form(0),
-    impurezas: float = Form(0),
-    dano_severo_insectos: float = Form(0),
-    parcial_negro: float = Form(0),
-    parcial_agrio: float = Form(0),
-    pergamino: float = Form(0),
-    flotador: float = Form(0),
-    inmaduro: float = Form(0),
-    averanado: float = Form(0),
-    concha: float = Form(0),
-    partido_mordido: float = Form(0),
-    cascara_pulpa_seca: float = Form(0),
-    dano_leve_insectos: float = Form(0),
-    perfil: str = Form("Frutos Citricos"),
-    caramelizacion: float = Form(0),
-    desarrollo: float = Form(0)
-):
-    if muestra_pergamino == 0:
+async def perfilado_submit_form(request: Request, data: Annotated[PerfiladoForm, Form()]):
+    """Handle Perfilado form submission and save to Perfilado worksheet."""
+    if data.muestra_pergamino == 0:
         perda_casca = 0
     else:
-        perda_casca = 1 - round(muestra_trillado/muestra_pergamino, 2)
-    """Handle Perfilado form submission and save to Perfilado worksheet."""
-    # Get valid IDs for dropdown
-    sheet_trillado = get_sheet("Trillado")
-    trillado_rows = sheet_trillado.get_all_values()
-    id_trillado_options = [r[5] for r in trillado_rows[1:] if len(r) > 5] if len(trillado_rows) > 1 else []
-
+        perda_casca = 1 - round(data.muestra_trillado/data.muestra_pergamino, 2)
     #id_perfilado
-    id_perfilado = id_trillado + "-"+perfil[:2].upper()
-
-    # Save to Perfilado worksheet
-    sheet_perfilado = get_sheet("Perfilado")
-    # Check for duplicate id_trillado in Perfilado worksheet (column 0)
-    perfilado_rows = sheet_perfilado.get_all_values()
-    existing_ids_perfilado = [r[0] for r in perfilado_rows[1:]] if len(perfilado_rows) > 1 else []
-    if id_trillado in existing_ids_perfilado:
-        msg = f"❌ Ya esta registrado! ID Trillado: {id_trillado}"
+    id_perfilado = f"{data.id_trillado}-{data.perfil[:2].upper()}"
+
+    # Save to Perfilado worksheet unless id_trillado is already there (column 0)
+    last_submission = data.model_dump()
+    values = list(last_submission.values())
+    # Columns follow the form fields, with Perda Casca after Humedad Grano Verde
+    row = [*values[:7], perda_casca, *values[7:], id_perfilado]
+    if await append_unique_row("Perfilado", 1, row):
+        msg = f"✅ Perfilado registrado! ID Trillado: {data.id_trillado}"
     else:
-        row = [
-            id_trillado, muestra_pergamino, humedad_pergamino, muestra_trillado, malla, densidad, humedad_grano_verde,perda_casca,
-            negro, agrio, cereza_seca, dano_hongo, impurezas, dano_severo_insectos, parcial_negro, parcial_agrio,
-            pergamino, flotador, inmaduro, averanado, concha, partido_mordido, cascara_pulpa_seca, dano_leve_insectos,
-            perfil, caramelizacion, desarrollo, id_perfilado
-        ]
-        sheet_perfilado.append_row(row)
-        msg = f"✅ Perfilado registrado! ID Trillado: {id_trillado}"
+        msg = f"❌ Ya esta registrado! ID Trillado: {data.id_trillado}"
 
-    last_submission = {
-        "id_trillado": id_trillado,
-        "muestra_pergamino": muestra_pergamino,
-        "humedad_pergamino": humedad_pergamino,
-        "muestra_trillado": muestra_trillado,
-        "malla": malla,
-        "densidad": densidad,
-        "humedad_grano_verde": humedad_grano_verde,
-        "negro": negro,
-        "agrio": agrio,
-        "cereza_seca": cereza_seca,
-        "dano_hongo": dano_hongo,
-        "impurezas": impurezas,
-        "dano_severo_insectos": dano_severo_insectos,
-        "parcial_negro": parcial_negro,
-        "parcial_agrio": parcial_agrio,
-        "pergamino": pergamino,
-        "flotador": flotador,
-        "inmaduro": inmaduro,
-        "averanado": averanado,
-        "concha": concha,
-        "partido_mordido": partido_mordido,
-        "cascara_pulpa_seca": cascara_pulpa_seca,
-        "dano_leve_insectos": dano_leve_insectos,
-        "perfil": perfil,
-        "caramelizacion": caramelizacion,
-        "desarrollo": desarrollo
-    }
-    defaults = last_submission.copy()
-    return templates.TemplateResponse(
+    return render(
         "perfilado.html",
         {
             "request": request,
             "msg": msg,
             "last_submission": last_submission,
-            "defaults": defaults,
-            "id_trillado_options": id_trillado_options
+            "defaults": last_submission,
+            "id_trillado_options": await get_id_options("Trillado", 6, stale_ok=True)
         }
     )
 
 
 # === Tostado GET and POST ===
+_TOSTADO_DEFAULTS = MappingProxyType({
+    "batch": "",
+    "cantidad_kg": "",
+    "caramelizacion": "",
+    "desarrollo": "",
+    "perfil_salida": "FC",
+    "id_tostado": ""
+})
+
+
 @app.get("/tostado", response_class=HTMLResponse)
-def tostado_form_page(request: Request):
+async def tostado_form_page(request: Request):
     """Show the Tostado form, with ID Perfilado options from Perfilado sheet."""
-    today = date.today().isoformat()
-    sheet_perfilado = get_sheet("Perfilado")
-    perfilado_rows = sheet_perfilado.get_all_values()
-    # Get all IDs from the last column (ID Perfilado)
-    id_perfilado_options = [r[-1] for r in perfilado_rows[1:] if len(r) > 0] if len(perfilado_rows) > 1 else []
+    today = today_str()
+    # Get all IDs from the last column (ID Perfilado, column AB)
+    id_perfilado_options = await get_id_options("Perfilado", 28)
     defaults = {
+        **_TOSTADO_DEFAULTS,
         "id_perfilado": id_perfilado_options[0] if id_perfilado_options else "",
-        "fecha_toste": today,
-        "batch": "",
-        "cantidad_kg": "",
-        "caramelizacion": "",
-        "desarrollo": "",
-        "perfil_salida": "FC",
-        "id_tostado": ""
+        "fecha_toste": today
     }
-    return templates.TemplateResponse(
+    return render(
         "tostado.html",
         {
             "request": request,
@@ -440,27 +647,17 @@ async def tostado_submit_form(
     perfil_salida: str = Form(...)
 ):
     """Handle Tostado form submission and save to Tostado worksheet."""
-    # Get valid IDs for dropdown
-    sheet_perfilado = get_sheet("Perfilado")
-    perfilado_rows = sheet_perfilado.get_all_values()
-    id_perfilado_options = [r[-1] for r in perfilado_rows[1:] if len(r) > 0] if len(perfilado_rows) > 1 else []
-
     # Generate ID Tostado
     id_tostado = f"{id_perfilado}-{batch}-{perfil_salida}"
 
-    # Save to Tostado worksheet
-    sheet_tostado = get_sheet("Tostado")
-    # Check for duplicate id_tostado in Tostado worksheet
-    tostado_rows = sheet_tostado.get_all_values()
-    existing_ids_tostado = [r[-1] for r in tostado_rows[1:] if len(r) > 0] if len(tostado_rows) > 1 else []
-    if id_tostado in existing_ids_tostado:
-        msg = f"❌ Ya esta registrado! ID Tostado: {id_tostado}"
-    else:
-        row = [
-            id_perfilado, fecha_toste, batch, cantidad_kg, caramelizacion, desarrollo, perfil_salida, id_tostado
-        ]
-        sheet_tostado.append_row(row)
+    # Save to Tostado worksheet unless id_tostado is already there
+    row = [
+        id_perfilado, fecha_toste, batch, cantidad_kg, caramelizacion, desarrollo, perfil_salida, id_tostado
+    ]
+    if await append_unique_row("Tostado", 8, row):
         msg = f"✅ Tostado registrado! ID Tostado: {id_tostado}"
+    else:
+        msg = f"❌ Ya esta registrado! ID Tostado: {id_tostado}"
 
     last_submission = {
         "id_perfilado": id_perfilado,
@@ -472,15 +669,14 @@ async def tostado_submit_form(
         "perfil_salida": perfil_salida,
         "id_tostado": id_tostado
     }
-    defaults = last_submission.copy()
-    return templates.TemplateResponse(
+    return render(
         "tostado.html",
         {
             "request": request,
             "msg": msg,
             "last_submission": last_submission,
-            "defaults": defaults,
-            "id_perfilado_options": id_perfilado_options
+            "defaults": last_submission,
+            "id_perfilado_options": await get_id_options("Perfilado", 28, stale_ok=True)
         }
     )
 